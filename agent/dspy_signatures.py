@@ -1,8 +1,13 @@
+import os
+import hashlib
+import json
 import dspy
 from typing import Literal
 from dspy.teleprompt import BootstrapFewShot
 from dspy.evaluate import Evaluate
 
+from agent.lm import llm, NUM_THREADS
+
 class RouterSignature(dspy.Signature):
     """
     Classifies a question into 'SQL', 'RAG', or 'Hybrid'.
@@ -58,8 +63,6 @@ class Synthesizer(dspy.ChainOfThought):
     def __init__(self):
         super().__init__(SynthesizerSignature)
         
-llm = dspy.LM("ollama_chat/phi3.5", api_base="http://localhost:11434")
-dspy.settings.configure(lm=llm)
 
 # --- 2. Create a Tiny Training Set ---
 # These are examples of the input (question, schema) and the desired output (sql_query)
@@ -174,6 +177,19 @@ trainset = [
     dspy.Example(question="Show the distinct regions where customers are located.", schema=schema, sql_query="SELECT DISTINCT Region FROM Customers").with_inputs("question", "schema"),
 ]
 
+# Compiled programs are cached under a key covering everything that affects
+# compilation, so changing the trainset, schema or model triggers a recompile.
+# The trainset is serialized canonically; repr() would include the input keys
+# as a set, whose order changes with PYTHONHASHSEED.
+MAX_BOOTSTRAPPED_DEMOS = 2
+_canonical_trainset = json.dumps(
+    [{**ex.toDict(), "_inputs": sorted(ex.inputs().keys())} for ex in trainset], sort_keys=True
+)
+_compile_key = hashlib.sha1(
+    _canonical_trainset.encode() + schema.encode() + llm.model.encode() + f"demos={MAX_BOOTSTRAPPED_DEMOS}".encode()
+).hexdigest()
+COMPILED_PROGRAM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.dspy_cache', f'{_compile_key}.json')
+
 # --- 3. Define the Evaluation Metric ---
 # We'll check if the generated SQL exactly matches the gold standard query.
 def sql_exact_match(example, pred, trace=None):
@@ -181,25 +197,31 @@ def sql_exact_match(example, pred, trace=None):
 
 # --- 4. Compare "Before" and "After" ---
 
-# BEFORE: Evaluate the un-optimized module
-unoptimized_text2sql = TextToSQL()
-evaluator = Evaluate(devset=trainset, num_threads=1, display_progress=True, display_table=5)
-print("--- Evaluating Unoptimized TextToSQL ---")
-evaluator(unoptimized_text2sql, metric=sql_exact_match)
-
 # AFTER: Optimize the module with BootstrapFewShot
 def optimization():
-    optimizer = BootstrapFewShot(metric=sql_exact_match, max_bootstrapped_demos=2)
+    optimizer = BootstrapFewShot(metric=sql_exact_match, max_bootstrapped_demos=MAX_BOOTSTRAPPED_DEMOS)
     optimized_text2sql = optimizer.compile(TextToSQL(), trainset=trainset)
+    # Save the compiled program so later runs can load it instead of re-compiling
+    os.makedirs(os.path.dirname(COMPILED_PROGRAM_PATH), exist_ok=True)
+    optimized_text2sql.save(COMPILED_PROGRAM_PATH)
     return optimized_text2sql
 
-print("\n--- Evaluating Optimized TextToSQL ---")
-optimized_text2sql = optimization()
-evaluator(optimized_text2sql, metric=sql_exact_match)
+# Only evaluate when run as a script, so importing the signatures stays cheap.
+# Run it as a module from the repo root so the 'agent' package is importable:
+#   python -m agent.dspy_signatures
+if __name__ == "__main__":
+    # BEFORE: Evaluate the un-optimized module
+    unoptimized_text2sql = TextToSQL()
+    evaluator = Evaluate(devset=trainset, num_threads=NUM_THREADS, display_progress=True, display_table=5)
+    print("--- Evaluating Unoptimized TextToSQL ---")
+    evaluator(unoptimized_text2sql, metric=sql_exact_match)
+
+    print("\n--- Evaluating Optimized TextToSQL ---")
+    optimized_text2sql = optimization()
+    evaluator(optimized_text2sql, metric=sql_exact_match)
 
 #print("\n--- Example Prediction from Optimized Model ---")
 #test_question = "Which products have a unit price greater than 50?"
 #prediction = optimized_text2sql(question=test_question, schema=schema)
 #print(f"Question: {test_question}")
 #print(f"Predicted SQL Query: {prediction.sql_query}")
-
@@ -1,20 +1,36 @@
 import os
-import json
-from typing import TypedDict, List, Any, Optional
+import re
+import hashlib
+import functools
+import threading
+from typing import TypedDict, Dict, List, Any, Optional
 import dspy
+import orjson
 from langgraph.graph import StateGraph, END
 
+from agent.lm import NUM_THREADS
 from agent.rag.retrieval import LocalRetriever
-from agent.dspy_signatures import Router, Synthesizer, schema, optimization
+from agent.semantic_cache import SemanticCache, ExactCache, embed_questions
+from agent.dspy_signatures import Router, TextToSQL, Synthesizer, schema, optimization, COMPILED_PROGRAM_PATH
 from agent.tools.sqlite_tool import run_sqlite_query
 
 
-llm = dspy.LM("ollama_chat/phi3.5", api_base="http://localhost:11434")
-dspy.settings.configure(lm=llm)
+# Number of questions sent to the LM concurrently in batch mode
+BATCH_NUM_THREADS = NUM_THREADS
+# SQL results longer than MAX_SQL_ROWS are cut to their first SQL_ROWS_SHOWN rows
+MAX_SQL_ROWS = 20
+SQL_ROWS_SHOWN = 10
+# Maximum number of characters of each retrieved document sent to the synthesizer
+MAX_DOC_CHARS = 800
+
 # Get the absolute path to the directory where this script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Construct the path to the 'docs' directory relative to this script
 docs_path = os.path.join(os.path.dirname(script_dir), 'docs')
+# File where the fitted retrieval index is cached
+index_path = os.path.join(os.path.dirname(script_dir), 'docs.idx')
+# Directory where the semantic caches persist prompts and responses
+cache_path = os.path.join(os.path.dirname(script_dir), '.semantic_cache')
 
 
 # --- 1. Define the State ---
@@ -26,7 +42,7 @@ class AgentState(TypedDict):
     format_hint: Optional[str]
     classification: str
     sql_query: str
-    sql_results: Optional[List[Any]]
+    sql_results: Optional[Dict[str, Any]]
     retrieved_docs: Optional[List[str]]
     errors: List[str]
     retry_count: int
@@ -34,29 +50,127 @@ class AgentState(TypedDict):
 
 
 # --- 2. Instantiate Tools & Modules ---
-retriever = LocalRetriever()
+retriever = LocalRetriever(index_path=index_path)
 retriever.index_directory(docs_path)
 
 router_module = Router()
-sql_generator_module = optimization() # Use the optimized TextToSQL module
 synthesizer_module = Synthesizer()
 
+# Skip the LM when a question was already answered. The router accepts
+# near-duplicates since its output is a single label; the synthesizer only
+# reuses answers for the same question and the exact same context, because
+# near-duplicates ("not returnable", "within 9 days") can need different answers.
+router_cache = SemanticCache(embed_questions, threshold=0.9, directory=os.path.join(cache_path, 'router'))
+synthesizer_cache = ExactCache(directory=os.path.join(cache_path, 'synthesizer'))
+
+_sql_generator_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def load_sql_generator():
+    """
+    Returns the optimized TextToSQL module, compiling it only on the first run.
+
+    The compiled program is loaded from disk when available; otherwise it is
+    compiled with BootstrapFewShot, which also saves it for later runs.
+    """
+    # Concurrent graph runs may race here on first use; only one should compile
+    with _sql_generator_lock:
+        if os.path.exists(COMPILED_PROGRAM_PATH):
+            module = TextToSQL()
+            module.load(COMPILED_PROGRAM_PATH)
+            return module
+        return optimization()
+
 
 # --- 3. Create Graph Nodes ---
 
+# Keywords that make the route of a question obvious without asking the LM
+_SQL_KEYWORDS = re.compile(r"\b(?:count|sum|average|total|top|list the|orders placed|unit price|revenue)\b")
+# Tables of the Northwind schema; a question must name one before it is sent to SQL
+_ENTITIES = r"(?:orders|order details|products?|customers?|categor(?:y|ies)|suppliers?|employees?|shippers?|quantity sold|units sold)"
+_ENTITY_KEYWORDS = re.compile(rf"\b{_ENTITIES}\b")
+# "How many" only counts when it counts entities, not e.g. days in a policy
+_COUNT_ENTITY = re.compile(rf"\bhow many (?:\w+ )?{_ENTITIES}\b")
+_RAG_KEYWORDS = re.compile(r"\b(?:policy|document|docs|according to|explain|definition|defined|calendar|kpi|catalog)\b")
+# Quoted names (e.g. campaigns) are often defined in the docs rather than the database
+_QUOTED_NAME = re.compile(r"'[^']+'")
+
+def quick_route(question: str) -> Optional[str]:
+    """
+    Classifies questions with obvious SQL cues using keyword rules.
+
+    A question is only routed here if it has an aggregation cue and names a
+    schema entity, so doc-only facts ("how many days ...") go to the Router.
+    A question that also has document cues goes to 'Hybrid'. Hybrid is not
+    free: it runs retrieval and calls the Synthesizer both after retrieval and
+    after SQL, so it is only chosen when the docs are explicitly referenced.
+
+    Returns:
+        'SQL' or 'Hybrid', or None if the Router should decide.
+    """
+    lowered = question.lower()
+    if not (_COUNT_ENTITY.search(lowered) or (_SQL_KEYWORDS.search(lowered) and _ENTITY_KEYWORDS.search(lowered))):
+        return None
+    if _RAG_KEYWORDS.search(lowered) or _QUOTED_NAME.search(question):
+        return 'Hybrid'
+    return 'SQL'
+
+def classify_questions(questions: List[str]) -> List[Optional[str]]:
+    """
+    Classifies a list of questions with a single batched call to the Router.
+    Questions matched by quick_route or found in the router cache are not sent to the LM.
+
+    Args:
+        questions: The questions to classify.
+
+    Returns:
+        A list of classifications in the same order as the questions. Entries are
+        None for questions the Router failed on; router_node classifies those again.
+    """
+    classifications = [quick_route(q) or router_cache.get(q) for q in questions]
+    misses = [i for i, c in enumerate(classifications) if c is None]
+    if misses:
+        examples = [dspy.Example(question=questions[i]).with_inputs("question") for i in misses]
+        predictions = router_module.batch(examples, num_threads=BATCH_NUM_THREADS)
+        for i, p in zip(misses, predictions):
+            if p is not None:
+                classifications[i] = p.classification
+                router_cache.set(questions[i], p.classification)
+    return classifications
+
 def router_node(state: AgentState):
-    """Calls the DSPy Router to classify the question."""
+    """Calls the DSPy Router to classify the question, unless it was pre-classified."""
     print("--- ROUTER ---")
-    classification = router_module(question=state['question']).classification
+    classification = state.get('classification') or quick_route(state['question']) or router_cache.get(state['question'])
+    if classification is None:
+        classification = router_module(question=state['question']).classification
+        router_cache.set(state['question'], classification)
     print(f"Classification: {classification}")
     return {"classification": classification, "errors": []}
 
+def truncate_text(text, limit):
+    """Cuts text to at most limit characters, preferring to end on a sentence boundary."""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    boundary = max(cut.rfind('. '), cut.rfind('\n'))
+    # Fall back to a hard cut if the last sentence ends too early
+    if boundary > limit // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip() + " ..."
+
 def retriever_node(state: AgentState):
     """Calls the local retriever to fetch relevant documents."""
     print("--- RETRIEVER ---")
     results = retriever.search(state['question'], k=3)
-    # Format for synthesizer: ['filename::chunk_id', 'content']
-    formatted_docs = [f"{res['chunk']['source']}::chunk_{res['chunk']['chunk_id']}\n{res['chunk']['content']}\n{res['score']}" for res in results]
+    # Format for synthesizer: ['filename::chunk_id', 'content']. Scores are only
+    # logged, since they add tokens and bias the model.
+    formatted_docs = []
+    for res in results:
+        # Look each field up once and reuse the citation for the log line
+        citation = f"{res['source']}::chunk_{res['chunk_id']}"
+        print(f"{citation} score={res['score']:.3f}")
+        formatted_docs.append(f"{citation}\n{truncate_text(res['content'], MAX_DOC_CHARS)}")
     print(f"Retrieved {len(formatted_docs)} documents.")
     return {"retrieved_docs": formatted_docs}
 
@@ -69,7 +183,7 @@ def sql_generator_node(state: AgentState):
         error_context = "\n".join(state['errors'])
         question_with_context = f"Previous attempt failed with error: {error_context}. Please correct the query. Original question: {state['question']}"
 
-    response = sql_generator_module(question=question_with_context, schema=schema)
+    response = load_sql_generator()(question=question_with_context, schema=schema)
     print(f"Generated SQL: {response.sql_query}")
     return {"sql_query": response.sql_query, "errors": []} # Clear previous errors
 
@@ -81,29 +195,51 @@ def sql_executor_node(state: AgentState):
 
     if column_names is not None: # Success
         print(f"Execution successful. Rows returned: {len(rows)}")
-        # Format results as a list of dictionaries for the synthesizer
-        results = [dict(zip(column_names, row)) for row in rows]
-        return {"sql_results": results}
+        # Keep results columnar; the synthesizer serializes them once
+        return {"sql_results": {"columns": column_names, "rows": rows}}
     else: # Error
         print(f"Execution failed. Error: {rows}")
         return {"errors": state.get('errors', []) + [rows], "retry_count": state.get('retry_count', 0) + 1}
 
+def format_sql_results(sql_results):
+    """
+    Serializes columnar SQL results for the synthesizer prompt.
+
+    Results with more than MAX_SQL_ROWS rows are cut to their first
+    SQL_ROWS_SHOWN rows, followed by a note with the number of rows left out.
+    """
+    rows = sql_results["rows"]
+    shown = rows if len(rows) <= MAX_SQL_ROWS else rows[:SQL_ROWS_SHOWN]
+    text = orjson.dumps({"columns": sql_results["columns"], "rows": shown}, default=str).decode()
+    if len(shown) < len(rows):
+        text += f"\n... ({len(rows) - len(shown)} more rows)"
+    return text
+
 def synthesizer_node(state: AgentState):
     """Synthesizes the final answer using results from SQL and RAG."""
     print("--- SYNTHESIZER ---")
     context = ""
-    if state.get('sql_results'):
-        context += f"SQL Results:\n{json.dumps(state.get('sql_results'), indent=2)}\n\n"
+    if state.get('sql_results') and state['sql_results']['rows']:
+        context += f"SQL Results:\n{format_sql_results(state['sql_results'])}\n\n"
     if state.get('retrieved_docs'):
         context += "Retrieved Documents:\n" + "\n\n".join(state.get('retrieved_docs'))
 
-    response = synthesizer_module(
+    inputs = dict(
         question=state['question'],
         context=context.strip(),
         sql_query=state.get('sql_query', ''),
         format_hint=state.get('format_hint', 'A clear and concise answer.')
     )
-    return {"final_answer": response.json_output}
+    # Everything besides the question that the answer depends on forms the scope,
+    # so a different context is always a miss
+    scope = hashlib.sha1("\0".join(str(inputs[key]) for key in ('context', 'sql_query', 'format_hint')).encode()).hexdigest()
+    final_answer = synthesizer_cache.get(inputs['question'], scope=scope)
+    if final_answer is None:
+        final_answer = synthesizer_module(**inputs).json_output
+        synthesizer_cache.set(inputs['question'], final_answer, scope=scope)
+    else:
+        print("Synthesizer cache hit.")
+    return {"final_answer": final_answer}
 
 
 # --- 4. Define Edges (Conditional Logic) ---
@@ -0,0 +1,25 @@
+import dspy
+
+# Number of requests sent to the LM concurrently. Launch the Ollama server with
+# OLLAMA_NUM_PARALLEL set to at least this value to benefit from it.
+NUM_THREADS = 8
+
+# The single LM shared by every module. cache=True serves repeated identical
+# prompts (e.g. during BootstrapFewShot compilation and retries) from disk.
+# keep_alive=-1 asks Ollama to keep the model loaded instead of unloading it
+# when idle (the server-wide equivalent is OLLAMA_KEEP_ALIVE=-1).
+llm = dspy.LM(
+    "ollama_chat/phi3.5",
+    api_base="http://localhost:11434",
+    model_type="chat",
+    cache=True,
+    keep_alive=-1,
+)
+dspy.settings.configure(lm=llm, async_max_workers=NUM_THREADS)
+
+def warm_up():
+    """
+    Sends a one-token request so the model is loaded before timing-sensitive work.
+    The response cache is bypassed, otherwise the request would never reach Ollama.
+    """
+    llm("ping", max_tokens=1, cache=False)
@@ -1,52 +1,193 @@
 import os
 import re
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import hashlib
+import threading
+import joblib
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import Pipeline
 import numpy as np
 
+# Optional: dense embeddings replace TF-IDF scoring when sentence-transformers is installed
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# Two or more newlines separate markdown paragraphs. The pattern works on the
+# raw UTF-8 bytes, where a newline byte never occurs inside a multi-byte character.
+# Line endings are normalized to '\n' first, as text mode would.
+_PARA_B = re.compile(rb'\n{2,}')
+
 class LocalRetriever:
     """
     A local retriever using TF-IDF to find relevant chunks from Markdown files.
+    If sentence-transformers is installed, chunks are ranked by dense embeddings instead.
     """
-    def __init__(self):
-        self.chunks = []
-        self.vectorizer = TfidfVectorizer(
-            stop_words='english', 
-            ngram_range=(1, 2), 
-            max_df=0.85, 
-            min_df=2
-        )
+    def __init__(self, index_path=None, embedding_model='all-MiniLM-L6-v2'):
+        """
+        Args:
+            index_path: Optional file where the fitted index is cached between runs.
+            embedding_model: The sentence-transformers model used for dense embeddings.
+        """
+        self.index_path = index_path
+        self.embedding_model = embedding_model if SentenceTransformer is not None else None
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+        # Dense, L2-normalized float32 chunk embeddings (memory-mapped when cached)
+        self.embeddings = None
+        # Chunk fields are stored as parallel arrays, one entry per chunk
+        self.contents = []
+        self.sources = np.empty(0, dtype=object)
+        self.chunk_ids = np.empty(0, dtype=np.int32)
+        # Hashing avoids storing a vocabulary; the transformer applies IDF weights
+        # and L2-normalizes rows. float32 halves the bytes of the matrix.
+        self.vectorizer = Pipeline([
+            ("hash", HashingVectorizer(
+                stop_words='english',
+                ngram_range=(1, 2),
+                n_features=2**18,
+                alternate_sign=False,
+                norm=None,
+                dtype=np.float32
+            )),
+            ("tfidf", TfidfTransformer())
+        ])
         self.tfidf_matrix = None
 
-    def _split_into_chunks(self, content, filename):
-        """Splits markdown content into paragraph chunks."""
-        # Split by two or more newlines to define paragraphs
-        paragraphs = re.split(r'\n\n+', content)
-        for i, para in enumerate(paragraphs):
-            if para.strip(): # Only add non-empty paragraphs
-                self.chunks.append({
-                    'content': para.strip(),
-                    'source': filename,
-                    'chunk_id': i
-                })
+    def _split_into_chunks(self, content):
+        """
+        Splits UTF-8 encoded markdown content into paragraph chunks.
+        Empty paragraphs are skipped but still count towards the chunk ids.
+
+        Returns:
+            A list of (chunk_id, paragraph) tuples for the non-empty paragraphs.
+        """
+        content = content.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        return [(i, para) for i, raw in enumerate(_PARA_B.split(content)) if (para := raw.decode('utf-8').strip())]
+
+    def _encode(self, texts):
+        """Encodes texts into L2-normalized float32 dense embeddings."""
+        # Concurrent searches may race here on first use; only one should load the model
+        with self._encoder_lock:
+            if self._encoder is None:
+                self._encoder = SentenceTransformer(self.embedding_model)
+        return self._encoder.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    def _fingerprint(self, filepaths):
+        """
+        Hashes the vectorizer and embedding configuration and the paths, sizes
+        and modification times of the indexed files.
+        """
+        digest = hashlib.sha1(f"{self.vectorizer!r}:{self.embedding_model}".encode())
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            digest.update(f"{filepath}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def _load_index(self, fingerprint):
+        """
+        Loads the cached index if it exists and matches the fingerprint.
+
+        Returns:
+            The cached tuple, or None on a cache miss. A missing, truncated or
+            otherwise unreadable file also counts as a miss, so it gets rebuilt.
+        """
+        if not self.index_path or not os.path.exists(self.index_path):
+            return None
+        try:
+            cached = joblib.load(self.index_path, mmap_mode='r')
+        except Exception:
+            return None
+        if not isinstance(cached, tuple) or len(cached) != 7 or cached[0] != fingerprint:
+            return None
+        return cached
+
+    @staticmethod
+    def _replace_file(path, write):
+        """
+        Writes a file through a temporary path and atomically moves it into place,
+        so readers (including processes that have the old file mapped) never see
+        a partially written file.
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _load_embeddings(embeddings_path, shape):
+        """Memory-maps the cached embeddings, or returns None if the file is missing or has the wrong size."""
+        try:
+            if os.path.getsize(embeddings_path) != shape[0] * shape[1] * np.dtype(np.float32).itemsize:
+                return None
+            return np.memmap(embeddings_path, dtype=np.float32, mode='r', shape=shape)
+        except (OSError, ValueError):
+            return None
+
+    def _store_embeddings(self, embeddings, embeddings_path):
+        """Writes the embeddings to embeddings_path (if set) and returns them memory-mapped from it."""
+        if not embeddings_path:
+            return embeddings
+        self._replace_file(embeddings_path, lambda tmp_path: np.ascontiguousarray(embeddings, dtype=np.float32).tofile(tmp_path))
+        return np.memmap(embeddings_path, dtype=np.float32, mode='r', shape=embeddings.shape)
 
     def index_directory(self, path):
         """
-        Walks through a directory, splits markdown files into chunks, and creates a TF-IDF index.
+        Walks through a directory, splits markdown files into chunks, and creates a TF-IDF index,
+        plus a dense embedding matrix if sentence-transformers is available.
+        If index_path is set and the files are unchanged since it was written, the
+        cached index is memory-mapped instead.
         
         Args:
             path: The path to the directory containing markdown files.
         """
+        filepaths = []
         for root, _, files in os.walk(path):
             for file in files:
                 if file.endswith(".md"):
-                    filepath = os.path.join(root, file)
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        self._split_into_chunks(f.read(), file)
+                    filepaths.append(os.path.join(root, file))
+        filepaths.sort()
+
+        fingerprint = self._fingerprint(filepaths)
+        embeddings_path = f"{self.index_path}.f32.bin" if self.index_path else None
+        cached = self._load_index(fingerprint)
+        if cached is not None:
+            _, self.vectorizer, self.tfidf_matrix, self.contents, self.sources, self.chunk_ids, dim = cached
+            if dim:
+                self.embeddings = self._load_embeddings(embeddings_path, (len(self.contents), dim))
+                if self.embeddings is None:
+                    # Missing or stale embeddings file; re-encode without refitting TF-IDF
+                    self.embeddings = self._store_embeddings(self._encode(self.contents), embeddings_path)
+            return
+
+        # Gather the paragraphs of all files so the vectorizer is fit in a single pass
+        contents, sources, chunk_ids = [], [], []
+        for filepath in filepaths:
+            with open(filepath, 'rb') as f:
+                chunks = self._split_into_chunks(f.read())
+            filename = os.path.basename(filepath)
+            contents.extend(para for _, para in chunks)
+            sources.extend(filename for _ in chunks)
+            chunk_ids.extend(i for i, _ in chunks)
         
-        if self.chunks:
-            chunk_contents = [chunk['content'] for chunk in self.chunks]
-            self.tfidf_matrix = self.vectorizer.fit_transform(chunk_contents)
+        if contents:
+            self.contents = contents
+            self.sources = np.array(sources, dtype=object)
+            self.chunk_ids = np.array(chunk_ids, dtype=np.int32)
+            self.tfidf_matrix = self.vectorizer.fit_transform(self.contents)
+            dim = None
+            if self.embedding_model:
+                embeddings = self._encode(self.contents)
+                dim = embeddings.shape[1]
+                self.embeddings = self._store_embeddings(embeddings, embeddings_path)
+            if self.index_path:
+                self._replace_file(self.index_path, lambda tmp_path: joblib.dump(
+                    (fingerprint, self.vectorizer, self.tfidf_matrix, self.contents, self.sources, self.chunk_ids, dim),
+                    tmp_path, compress=0
+                ))
 
     def search(self, query, k=5):
         """
@@ -57,27 +198,33 @@ class LocalRetriever:
             k: The number of top chunks to return.
 
         Returns:
-            A list of dictionaries, where each dictionary contains a chunk 
-            and its relevance score. Returns an empty list if not indexed.
+            A list of dictionaries with the 'score', 'content', 'source' and
+            'chunk_id' of each chunk. Returns an empty list if not indexed.
         """
-        if self.tfidf_matrix is None or not self.chunks:
+        if self.tfidf_matrix is None or not self.contents:
             print("No documents have been indexed. Please call index_directory() first.")
             return []
 
-        query_vector = self.vectorizer.transform([query])
-        
-        # Calculate cosine similarity between the query and all chunks
-        cosine_similarities = cosine_similarity(query_vector, self.tfidf_matrix).flatten()
+        # Rows are L2-normalized in both representations, so cosine similarity is a
+        # plain dot product: one dense matrix-vector product, or a sparse one for TF-IDF
+        if self.embeddings is not None:
+            scores = self.embeddings @ self._encode([query])[0]
+        else:
+            query_vector = self.vectorizer.transform([query])
+            scores = (self.tfidf_matrix @ query_vector.T).toarray().ravel()
         
-        # Get the indices of the top k chunks
-        # np.argsort returns indices of the sorted array in ascending order
-        # We use [-k:] to get the top k and then [::-1] to reverse for descending order
-        top_k_indices = np.argsort(cosine_similarities)[-k:][::-1]
+        # Select the top k chunks without sorting all scores, then order only those
+        k = min(k, len(scores))
+        top_k_indices = np.argpartition(-scores, k - 1)[:k]
+        top_k_indices = top_k_indices[np.argsort(-scores[top_k_indices])]
         
-        results = []
-        for i in top_k_indices:
-            results.append({
-                'score': cosine_similarities[i],
-                'chunk': self.chunks[i]
-            })
-        return results
\ No newline at end of file
+        # Gather the fields of all top chunks at once from the parallel arrays
+        return [
+            {'score': score, 'content': self.contents[i], 'source': source, 'chunk_id': chunk_id}
+            for i, score, source, chunk_id in zip(
+                top_k_indices.tolist(),
+                scores[top_k_indices].tolist(),
+                self.sources[top_k_indices],
+                self.chunk_ids[top_k_indices].tolist()
+            )
+        ]
\ No newline at end of file
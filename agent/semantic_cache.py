@@ -0,0 +1,134 @@
+import re
+import threading
+import diskcache
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+
+# Stateless question embedder. Unlike the retriever's vectorizer it keeps stop
+# words and single-character tokens, so negations ("not", "no") and digits
+# still change the embedding.
+_QUESTION_VECTORIZER = HashingVectorizer(
+    token_pattern=r"(?u)\b\w+\b",
+    ngram_range=(1, 2),
+    alternate_sign=False,
+    dtype=np.float32
+)
+
+def embed_questions(texts):
+    """Embeds a list of texts into a sparse matrix with one L2-normalized row per text."""
+    return _QUESTION_VECTORIZER.transform(texts)
+
+def normalize_prompt(prompt):
+    """Lowercases a prompt and collapses whitespace, for exact-match lookups."""
+    return re.sub(r"\s+", " ", prompt).strip().lower()
+
+class _Scope:
+    """The stored prompt embeddings and responses that share one exact scope key."""
+    def __init__(self):
+        self.rows = []
+        self.responses = []
+        self.keys = None
+
+    def add(self, embeddings, responses):
+        for i, response in enumerate(responses):
+            row = embeddings[i]
+            # Prompts sharing no terms with the vocabulary can't be compared reliably
+            if row.nnz:
+                self.rows.append(row)
+                self.responses.append(response)
+        self.keys = None
+
+    def matrix(self):
+        # Stack lazily, so inserts don't copy the whole key matrix each time
+        if self.keys is None and self.rows:
+            self.keys = sp.vstack(self.rows, format='csr')
+        return self.keys
+
+class SemanticCache:
+    """
+    A prompt cache that returns a stored response when a new prompt is similar
+    enough to a previously seen one, measured by cosine similarity of embeddings.
+
+    Entries may be grouped under an exact scope key; a lookup only considers
+    prompts stored under the same scope.
+    """
+    def __init__(self, embed, threshold, directory):
+        """
+        Args:
+            embed: A function mapping a list of texts to a sparse matrix of
+                L2-normalized rows, one per text.
+            threshold: The minimum cosine similarity for a lookup to count as a hit.
+            directory: The directory where prompts and responses are persisted.
+        """
+        self.embed = embed
+        self.threshold = threshold
+        self.store = diskcache.Cache(directory)
+        self.scopes = {}
+        self.lock = threading.Lock()
+
+        # Re-embed persisted prompts, since the embedding may change between runs.
+        # Each scope is embedded with a single call.
+        grouped = {}
+        for key in self.store:
+            if not (isinstance(key, tuple) and len(key) == 2):
+                continue
+            scope, prompt = key
+            grouped.setdefault(scope, ([], []))
+            grouped[scope][0].append(prompt)
+            grouped[scope][1].append(self.store[key])
+        for scope, (prompts, responses) in grouped.items():
+            self.scopes.setdefault(scope, _Scope()).add(self.embed(prompts), responses)
+
+    def get(self, prompt, scope=None):
+        """
+        Looks up the response of the most similar stored prompt.
+
+        Args:
+            prompt: The prompt text.
+            scope: An exact key the stored prompt must share (e.g. a context hash).
+
+        Returns:
+            The stored response if its similarity exceeds the threshold, otherwise None.
+        """
+        embedding = self.embed([prompt])
+        if embedding.nnz == 0:
+            return None
+        with self.lock:
+            entries = self.scopes.get(scope)
+            keys = entries.matrix() if entries else None
+            if keys is None:
+                return None
+            similarities = (keys @ embedding.T).toarray().ravel()
+            best = similarities.argmax()
+            if similarities[best] >= self.threshold:
+                return entries.responses[best]
+        return None
+
+    def set(self, prompt, response, scope=None):
+        """Stores a response for the given prompt and scope, in memory and on disk."""
+        embedding = self.embed([prompt])
+        with self.lock:
+            self.scopes.setdefault(scope, _Scope()).add(embedding, [response])
+            self.store[(scope, prompt)] = response
+
+class ExactCache:
+    """
+    A prompt cache that only returns a stored response for the same normalized
+    prompt under the same scope. Used where near-duplicate prompts may need
+    different answers.
+    """
+    def __init__(self, directory):
+        """
+        Args:
+            directory: The directory where prompts and responses are persisted.
+        """
+        self.store = diskcache.Cache(directory)
+
+    def get(self, prompt, scope=None):
+        """Returns the stored response for the prompt and scope, or None."""
+        return self.store.get((scope, normalize_prompt(prompt)))
+
+    def set(self, prompt, response, scope=None):
+        """Stores a response for the given prompt and scope on disk."""
+        self.store[(scope, normalize_prompt(prompt))] = response
@@ -1,24 +1,48 @@
 import sqlite3
+import functools
+import threading
+
+# Each thread keeps its own open connection to the database
+_tls = threading.local()
+
+def _conn():
+    """Returns this thread's read-only connection to northwind.sqlite, opening it on first use."""
+    if not hasattr(_tls, 'c'):
+        _tls.c = sqlite3.connect('northwind.sqlite', check_same_thread=False, isolation_level=None)
+        # Serve reads from memory-mapped pages and a larger page cache
+        _tls.c.execute('PRAGMA mmap_size=268435456')
+        _tls.c.execute('PRAGMA cache_size=-65536')
+        _tls.c.execute('PRAGMA query_only=1')
+    return _tls.c
+
+@functools.lru_cache(maxsize=256)
+def _execute(query):
+    """
+    Executes a query and returns its rows and column names as tuples.
+    Errors are raised rather than returned, so failed queries are not cached.
+    """
+    cursor = _conn().execute(query)
+    rows = tuple(cursor.fetchall())
+    # Return empty column names if the query doesn't produce columns (e.g., INSERT, UPDATE)
+    column_names = tuple(description[0] for description in cursor.description) if cursor.description else ()
+    return rows, column_names
 
 def run_sqlite_query(query):
     """
-    Connects to northwind.sqlite, executes the given SQL query, and returns
+    Executes the given SQL query against northwind.sqlite and returns
     the rows and column names.
 
+    The database is opened read-only and the connection is reused per thread.
+    Results of repeated identical queries are served from an in-process cache.
+
     Args:
         query: The SQL query string to execute.
 
     Returns:
-        A tuple containing the list of rows and a list of column names.
+        A tuple containing the rows and the column names.
         If an error occurs, it returns a tuple with the error message string and None.
     """
     try:
-        with sqlite3.connect('northwind.sqlite') as conn:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            # Return an empty list for column names if the query doesn't produce columns (e.g., INSERT, UPDATE)
-            column_names = [description[0] for description in cursor.description] if cursor.description else []
-            return rows, column_names
+        return _execute(query)
     except sqlite3.Error as e:
         return str(e), None
@@ -1,12 +1,93 @@
 import argparse
+import ast
 import json
+import re
 import uuid
 import os
-from agent.graph_hybrid import app, AgentState
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from agent.lm import warm_up
+from agent.graph_hybrid import app, AgentState, BATCH_NUM_THREADS, classify_questions
 
 # Get the directory where this script is located to resolve file paths
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
+# Matches quoted strings (so brackets inside them are skipped) and brackets
+_JSON_TOKEN_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|[{}\[\]]')
+
+# Matches whitespace and an optional opening ```json fence at the start of the output
+_LEADING_FENCE_RE = re.compile(r'\s*(?:```(?:json)?\s*)?')
+
+# Matches quoted strings (kept as-is) and commas directly before a closing bracket
+_TRAILING_COMMA_RE = re.compile(r'"(?:\\.|[^"\\])*"|,(?=\s*[}\]])')
+
+def _parse_block(block: str):
+    """
+    Parses a single object or array. Trailing commas are tolerated, and Python
+    literals are accepted as a fallback as long as they are JSON-serializable.
+    """
+    try:
+        return orjson.loads(block)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        return orjson.loads(_TRAILING_COMMA_RE.sub(lambda m: '' if m.group() == ',' else m.group(), block))
+    except orjson.JSONDecodeError:
+        pass
+    # Small models often emit Python dict literals instead of JSON
+    try:
+        result = ast.literal_eval(block)
+        # Reject literals JSON can't represent (sets, bytes, non-string keys, ...)
+        if isinstance(result, (dict, list)):
+            orjson.dumps(result)
+            return result
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        pass
+    raise ValueError(f"Could not parse JSON value: {block}")
+
+def _scan_block(raw_output: str, start: int) -> Optional[str]:
+    """Returns the bracketed block opening at start, or None if it never closes."""
+    depth = 0
+    for match in _JSON_TOKEN_RE.finditer(raw_output, start):
+        token = match.group()
+        if token in ('{', '['):
+            depth += 1
+        elif token in ('}', ']'):
+            depth -= 1
+            if depth == 0:
+                return raw_output[start:match.end()]
+    return None
+
+def extract_json(raw_output: str):
+    """
+    Parses the model output as JSON. If the whole output isn't valid JSON, a
+    leading array or else the first object in it is parsed instead, ignoring
+    surrounding prose and ```json fences.
+
+    Args:
+        raw_output: The raw text produced by the synthesizer.
+
+    Returns:
+        The parsed value (usually a dict, or a list for list-typed answers).
+
+    Raises:
+        ValueError: If no complete object or array is found or it can't be parsed.
+    """
+    try:
+        return orjson.loads(raw_output.strip())
+    except orjson.JSONDecodeError:
+        pass
+    # An array is only taken when it leads the output, so bracketed prose like
+    # "[1]" doesn't shadow the object. Quotes are only tracked inside the
+    # block, so apostrophes in prose are ignored.
+    leading = _LEADING_FENCE_RE.match(raw_output).end()
+    start = leading if raw_output.startswith('[', leading) else raw_output.find('{')
+    block = _scan_block(raw_output, start) if start != -1 else None
+    if block is None:
+        raise ValueError("No JSON object or array found in the model output.")
+    return _parse_block(block)
+
 def run_batch(input_file: str, output_file: str):
     """
     Processes a batch of questions from an input JSONL file and writes the
@@ -25,41 +106,50 @@ def run_batch(input_file: str, output_file: str):
         for line in f:
             questions.append(json.loads(line))
 
-    with open(abs_output_file, 'w') as f_out:
-        for i, item in enumerate(questions):
-            print(f"--- Processing Question {i+1}/{len(questions)} ---")
-            print(f"Question: {item['question']}")
-
-            # Each conversation gets a unique thread_id for checkpointing
-            thread_id = str(uuid.uuid4())
-            config = {"configurable": {"thread_id": thread_id}}
-
-            # Define the initial state for the graph
-            initial_state: AgentState = {
-                "question": item["question"],
-                "format_hint": item.get("format_hint"),
-                "retry_count": 0,
-                "errors": [],
-                # Initialize other keys to avoid potential KeyErrors in nodes
-                "classification": None,
-                "sql_query": None,
-                "sql_results": None,
-                "retrieved_docs": None,
-                "final_answer": None,
-            }
-
-            # Invoke the LangGraph app
-            final_state = app.invoke(initial_state, config=config)
+    # Load the model up front so the first question doesn't pay for it
+    print("--- Warming up the LM ---")
+    warm_up()
+
+    # Phase 1: classify every question with one batched Router call
+    print(f"--- Routing {len(questions)} questions ---")
+    classifications = classify_questions([item["question"] for item in questions])
+
+    # Phase 2: run the per-question graphs concurrently. The router node keeps
+    # the precomputed classification and only the diverging SQL/RAG flow runs.
+    def invoke(item, classification):
+        """Runs the graph for one question and returns its final state."""
+        # Define the initial state for the graph
+        initial_state: AgentState = {
+            "question": item["question"],
+            "format_hint": item.get("format_hint"),
+            "retry_count": 0,
+            "errors": [],
+            "classification": classification,
+            # Initialize other keys to avoid potential KeyErrors in nodes
+            "sql_query": None,
+            "sql_results": None,
+            "retrieved_docs": None,
+            "final_answer": None,
+        }
+        # Each conversation gets a unique thread_id for checkpointing
+        config = {"configurable": {"thread_id": str(uuid.uuid4())}}
+        return app.invoke(initial_state, config=config)
 
+    print(f"--- Processing {len(questions)} questions with {BATCH_NUM_THREADS} workers ---")
+    with ThreadPoolExecutor(max_workers=BATCH_NUM_THREADS) as executor, open(abs_output_file, 'w') as f_out:
+        # map() yields results in input order, so each line is written as soon
+        # as it and every earlier question have finished
+        final_states = executor.map(invoke, questions, classifications)
+        for i, (item, final_state) in enumerate(zip(questions, final_states)):
             output_json = {}
             try:
                 # The 'final_answer' from the synthesizer is a JSON string, so we parse it
                 raw_output = final_state.get("final_answer")
                 if raw_output:
-                    output_json = json.loads(raw_output)
+                    output_json = extract_json(raw_output)
                 else:
                     raise ValueError("Final answer from the agent was empty.")
-            except (json.JSONDecodeError, ValueError) as e:
+            except ValueError as e:
                 print(f"!!! ERROR: Failed to parse JSON output for question {i+1}. Writing error to output file. !!!")
                 print(f"    Error: {e}")
                 print(f"    Model Output: {raw_output}")
@@ -68,7 +158,9 @@ def run_batch(input_file: str, output_file: str):
 
             # Write the structured JSON output to the output file
             f_out.write(json.dumps(output_json) + '\n')
-            print(f"--- Finished. Result written to {abs_output_file} ---\n")
+            f_out.flush()
+            print(f"--- Finished question {i+1}/{len(questions)} ---")
+    print(f"--- Finished. Results written to {abs_output_file} ---\n")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the Hybrid RAG Agent on a batch of questions.")
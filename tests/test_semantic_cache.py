@@ -0,0 +1,36 @@
+from agent.semantic_cache import SemanticCache, ExactCache, embed_questions
+
+
+def test_semantic_cache_hits_near_duplicate(tmp_path):
+    cache = SemanticCache(embed_questions, threshold=0.9, directory=str(tmp_path))
+    cache.set("How many orders were placed in 1997?", "SQL")
+    assert cache.get("how many orders were placed in 1997") == "SQL"
+
+
+def test_semantic_cache_misses_negated_question(tmp_path):
+    cache = SemanticCache(embed_questions, threshold=0.9, directory=str(tmp_path))
+    cache.set("Which Beverages are returnable?", "14 days")
+    assert cache.get("Which Beverages are not returnable?") is None
+
+
+def test_semantic_cache_misses_different_digit(tmp_path):
+    cache = SemanticCache(embed_questions, threshold=0.9, directory=str(tmp_path))
+    cache.set("Which products can be returned within 7 days?", "A")
+    assert cache.get("Which products can be returned within 9 days?") is None
+
+
+def test_semantic_cache_persists_and_respects_scope(tmp_path):
+    cache = SemanticCache(embed_questions, threshold=0.9, directory=str(tmp_path))
+    cache.set("Which Beverages are returnable?", "14 days", scope="a")
+    reloaded = SemanticCache(embed_questions, threshold=0.9, directory=str(tmp_path))
+    assert reloaded.get("Which Beverages are returnable?", scope="a") == "14 days"
+    assert reloaded.get("Which Beverages are returnable?", scope="b") is None
+    assert reloaded.get("Which Beverages are not returnable?", scope="a") is None
+
+
+def test_exact_cache_matches_only_normalized_prompt(tmp_path):
+    cache = ExactCache(directory=str(tmp_path))
+    cache.set("Which Beverages are returnable?", "14 days", scope="ctx")
+    assert cache.get("  which beverages  are returnable? ", scope="ctx") == "14 days"
+    assert cache.get("Which Beverages are not returnable?", scope="ctx") is None
+    assert cache.get("Which Beverages are returnable?", scope="other") is None